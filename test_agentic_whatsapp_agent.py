@@ -0,0 +1,464 @@
+import json
+import os
+import queue
+import sqlite3
+import subprocess
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import agentic_whatsapp_agent as agent
+
+
+class FakeStream:
+    def __init__(self, pieces, usage=None):
+        self.chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=p))], usage=None)
+                       for p in pieces]
+        self.chunks.append(SimpleNamespace(choices=[], usage=usage))
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeOpenAI:
+    """
+    Stands in for OpenAI(): streamed calls get `stream_pieces`, plain calls
+    get `content` as the completion text. Every call's kwargs are recorded.
+    """
+    def __init__(self, content="", stream_pieces=()):
+        self.content = content
+        self.stream_pieces = stream_pieces
+        self.calls = []
+        self.streams = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        if kwargs.get("stream"):
+            stream = FakeStream(self.stream_pieces)
+            self.streams.append(stream)
+            return stream
+        message = SimpleNamespace(content=self.content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+class FakeBatchOpenAI(FakeOpenAI):
+    """
+    Adds the Batch API: the job reports each status in `statuses` on
+    successive polls, then answers every request but those in `failing`.
+    """
+    def __init__(self, statuses=("completed",), failing=()):
+        super().__init__()
+        self.statuses = list(statuses)
+        self.failing = set(failing)
+        self.requests = []
+        self.files = SimpleNamespace(create=self._upload, content=self._download)
+        self.batches = SimpleNamespace(create=self._submit, retrieve=self._poll)
+
+    def _upload(self, file, purpose):
+        self.requests = [json.loads(line) for line in file[1].decode("utf-8").splitlines()]
+        return SimpleNamespace(id="file-in")
+
+    def _submit(self, input_file_id, endpoint, completion_window):
+        return SimpleNamespace(id="batch-1", status="validating", output_file_id=None)
+
+    def _poll(self, batch_id):
+        status = self.statuses.pop(0)
+        return SimpleNamespace(id=batch_id, status=status,
+                               output_file_id="file-out" if status == "completed" else None)
+
+    def _download(self, file_id):
+        lines = []
+        # Output order doesn't follow input order
+        for req in reversed(self.requests):
+            if req["custom_id"] in self.failing:
+                result = {"custom_id": req["custom_id"], "response": None,
+                          "error": {"code": "server_error", "message": "boom"}}
+            else:
+                content = "re: " + req["body"]["messages"][-1]["content"]
+                result = {"custom_id": req["custom_id"], "error": None, "response": {
+                    "status_code": 200, "body": {"choices": [{"message": {"content": content}}]}}}
+            lines.append(json.dumps(result))
+        return SimpleNamespace(text="\n".join(lines))
+
+
+class FakeTwilio:
+    def __init__(self):
+        self.sent = []
+        self.messages = SimpleNamespace(create=self._create)
+
+    def _create(self, body, from_, to):
+        self.sent.append((body, to))
+        return SimpleNamespace(sid=f"SM{len(self.sent)}")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class FakeEmbedder:
+    # Messages sharing a first word get the same vector, i.e. are paraphrases
+    def __init__(self, model_name):
+        pass
+
+    def get_sentence_embedding_dimension(self):
+        return 4
+
+    def encode(self, texts, normalize_embeddings=True):
+        import numpy as np
+        vecs = []
+        for text in texts:
+            vec = np.zeros(4, dtype="float32")
+            vec[hash(text.lower().split()[0]) % 4] = 1.0
+            vecs.append(vec)
+        return np.stack(vecs)
+
+
+def make_state(openai_client=None, llm_generate=None, response_cache=None, semantic_cache=None):
+    return agent.AgentState(
+        config={},
+        greeting="Hello!",
+        language="en",
+        system_prompt="You are kind.",
+        system_prompt_hash="persona-hash",
+        twilio_client=FakeTwilio(),
+        openai_client=openai_client or FakeOpenAI(),
+        llm_generate=llm_generate or agent._openai_generate,
+        response_cache=response_cache or agent.ResponseCache(100, 3600),
+        semantic_cache=semantic_cache
+    )
+
+
+@pytest.fixture
+def fake_embedder(monkeypatch):
+    """Real faiss, fake sentence-transformers; returns numpy."""
+    faiss = pytest.importorskip("faiss")
+    np = pytest.importorskip("numpy")
+    monkeypatch.setattr(agent, "faiss", faiss)
+    monkeypatch.setattr(agent, "np", np)
+    monkeypatch.setitem(sys.modules, "sentence_transformers", SimpleNamespace(SentenceTransformer=FakeEmbedder))
+    return np
+
+
+@pytest.fixture
+def use_state(monkeypatch):
+    def install(state):
+        monkeypatch.setattr(agent, "get_state", lambda: state)
+        return state
+    return install
+
+
+def test_batch_fans_replies_out_in_order(use_state):
+    client = FakeOpenAI(content=json.dumps({"2": "second", "1": "first", "3": "third"}))
+    use_state(make_state(openai_client=client))
+    batch = [("one", Future(), None), ("two", Future(), None), ("three", Future(), None)]
+
+    agent._run_batch(batch)
+
+    assert [future.result() for _, future, _ in batch] == ["first", "second", "third"]
+    assert len(client.calls) == 1
+    # Messages are sent as JSON, so one can't fake another's entry
+    assert json.loads(client.calls[0]["messages"][-1]["content"]) == {"1": "one", "2": "two", "3": "three"}
+
+
+def test_batch_falls_back_per_message_on_malformed_json(use_state):
+    client = FakeOpenAI(content="Sure! Here you go", stream_pieces=["solo reply"])
+    use_state(make_state(openai_client=client))
+
+    replies = agent.generate_batch_response(["one", "two"])
+
+    assert replies == ["solo reply", "solo reply"]
+    assert [call.get("stream", False) for call in client.calls] == [False, True, True]
+    assert all(stream.closed for stream in client.streams)
+
+
+def test_response_cache_expires(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(agent, "time", clock)
+    cache = agent.ResponseCache(100, ttl=10)
+
+    cache.set("key", "reply")
+    clock.now += 9
+    assert cache.get("key") == "reply"
+    clock.now += 2
+    assert cache.get("key") is None
+
+
+def test_response_cache_persists_until_ttl(monkeypatch, tmp_path):
+    clock = FakeClock()
+    monkeypatch.setattr(agent, "time", clock)
+    db = str(tmp_path / "cache.db")
+
+    agent.ResponseCache(100, 10, agent.CacheStore(db, 10)).set(("k",), "reply")
+    # A fresh cache, as after a restart, falls back to SQLite
+    assert agent.ResponseCache(100, 10, agent.CacheStore(db, 10)).get(("k",)) == "reply"
+    clock.now += 11
+    assert agent.ResponseCache(100, 10, agent.CacheStore(db, 10)).get(("k",)) is None
+
+
+def test_semantic_hits_expire_with_the_exact_cache(monkeypatch, use_state, fake_embedder):
+    monkeypatch.setattr(agent, "RESPONSE_CACHE_ENABLED", True)
+    clock = FakeClock()
+    monkeypatch.setattr(agent, "time", clock)
+
+    calls = []
+    def llm_generate(user_message, persona, on_first_sentence=None, max_tokens=None):
+        calls.append(user_message)
+        return f"reply {len(calls)}"
+
+    use_state(make_state(
+        llm_generate=llm_generate,
+        response_cache=agent.ResponseCache(100, 10),
+        semantic_cache=agent.SemanticCache("fake", 0.92, "scope", ttl=10, maxsize=100)
+    ))
+
+    assert agent.dispatch_response("hello there") == "reply 1"
+    clock.now += 5
+    # Paraphrase: semantic hit, no LLM call
+    assert agent.dispatch_response("hello friend") == "reply 1"
+    clock.now += 6
+    # Both the exact entry and the semantic entry it came from have expired
+    assert agent.dispatch_response("hello friend") == "reply 2"
+    assert calls == ["hello there", "hello friend"]
+
+
+def test_semantic_cache_evicts_oldest_past_maxsize(fake_embedder):
+    np = fake_embedder
+    cache = agent.SemanticCache("fake", 0.92, "scope", ttl=3600, maxsize=2)
+
+    for i in range(3):
+        cache.add(np.eye(4, dtype="float32")[i:i + 1], f"reply {i}")
+
+    assert cache.replies == ["reply 1", "reply 2"]
+    assert cache.index.ntotal == 2
+    assert cache.lookup(np.eye(4, dtype="float32")[0:1]) is None
+    assert cache.lookup(np.eye(4, dtype="float32")[2:3])[0] == "reply 2"
+
+
+def post_webhook(body):
+    return agent.app.test_client().post("/webhook", data={"Body": body, "From": "whatsapp:+15550001"})
+
+
+def test_early_flush_sends_first_sentence_separately(monkeypatch, use_state):
+    monkeypatch.setattr(agent, "EARLY_FLUSH", True)
+    client = FakeOpenAI(stream_pieces=["Oh no", ", I'm sorry. ", "Want to ", "talk about it?"])
+    state = use_state(make_state(openai_client=client))
+
+    response = post_webhook("Rough day")
+
+    assert response.status_code == 200
+    assert [body for body, _ in state.twilio_client.sent] == ["Oh no, I'm sorry. ", "Want to talk about it?"]
+
+
+def test_replies_go_out_whole_without_early_flush(monkeypatch, use_state):
+    monkeypatch.setattr(agent, "EARLY_FLUSH", False)
+    client = FakeOpenAI(stream_pieces=["Oh no", ", I'm sorry. ", "Want to ", "talk about it?"])
+    state = use_state(make_state(openai_client=client))
+
+    response = post_webhook("Rough day")
+
+    assert response.status_code == 200
+    assert [body for body, _ in state.twilio_client.sent] == ["Oh no, I'm sorry. Want to talk about it?"]
+
+
+def test_unbatched_calls_run_concurrently(monkeypatch, use_state):
+    monkeypatch.setattr(agent, "MAX_BATCH", 1)
+    n = 24
+    # Only releases once all n calls are in flight at the same time
+    barrier = threading.Barrier(n, timeout=5)
+    def llm_generate(user_message, persona, on_first_sentence=None, max_tokens=None):
+        barrier.wait()
+        return user_message.upper()
+    use_state(make_state(llm_generate=llm_generate))
+
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        replies = list(pool.map(agent.dispatch_response, [f"msg {i}" for i in range(n)]))
+
+    assert replies == [f"MSG {i}" for i in range(n)]
+
+
+def test_batched_dispatch_answers_each_caller(monkeypatch, use_state):
+    monkeypatch.setattr(agent, "MAX_BATCH", 3)
+    monkeypatch.setattr(agent, "BATCH_WINDOW_MS", 2000)
+    client = FakeOpenAI(content=json.dumps({"1": "reply 1", "2": "reply 2", "3": "reply 3"}))
+    use_state(make_state(openai_client=client))
+    # The worker reads the batch settings when it starts
+    monkeypatch.setattr(agent, "_batch_worker", None)
+    monkeypatch.setattr(agent, "_batch_queue", queue.Queue())
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        replies = dict(zip(["a", "b", "c"], pool.map(agent.dispatch_response, ["a", "b", "c"])))
+
+    assert len(client.calls) == 1
+    sent = json.loads(client.calls[0]["messages"][-1]["content"])
+    assert replies == {message: f"reply {i}" for i, message in sent.items()}
+
+
+def test_import_leaves_embedding_libraries_unloaded(tmp_path):
+    # A stand-in package that records whether anything imported it
+    package = tmp_path / "sentence_transformers"
+    package.mkdir()
+    (package / "__init__.py").write_text("class SentenceTransformer: pass\n")
+    code = "import sys, agentic_whatsapp_agent; print('sentence_transformers' in sys.modules)"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([str(tmp_path), os.path.dirname(agent.__file__)])}
+    out = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == "False"
+
+
+def test_no_cache_file_while_caching_is_off(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "persona_config.json").write_text('{"persona": "You are kind."}')
+    monkeypatch.setattr(agent, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(agent, "RESPONSE_CACHE_ENABLED", False)
+
+    state = agent.get_state.__wrapped__()
+
+    assert state.response_cache.store is None
+    assert not (tmp_path / "cache.db").exists()
+
+
+def count_rows(db, table):
+    with sqlite3.connect(db) as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def test_cache_store_purges_expired_rows(monkeypatch, tmp_path):
+    clock = FakeClock()
+    monkeypatch.setattr(agent, "time", clock)
+    monkeypatch.setattr(agent, "CACHE_PURGE_EVERY", 3)
+    db = str(tmp_path / "cache.db")
+    store = agent.CacheStore(db, ttl=10)
+    store.set_reply("old", "reply", stored_at=clock.now - 20)
+    store.add_semantic("scope", b"vec", "reply", clock.now - 20)
+    assert (count_rows(db, "resp"), count_rows(db, "semantic")) == (1, 1)
+
+    # The third write triggers a purge of both tables
+    store.set_reply("new", "reply")
+    assert (count_rows(db, "resp"), count_rows(db, "semantic")) == (1, 0)
+
+    # So does opening the file again
+    clock.now += 11
+    agent.CacheStore(db, ttl=10)
+    assert count_rows(db, "resp") == 0
+
+
+def test_cache_store_migrates_semantic_rows_without_timestamps(tmp_path):
+    db = str(tmp_path / "cache.db")
+    with sqlite3.connect(db) as conn:
+        conn.execute("CREATE TABLE semantic(scope TEXT, vec BLOB, reply TEXT)")
+        conn.execute("INSERT INTO semantic VALUES ('scope', x'00', 'undatable')")
+
+    store = agent.CacheStore(db, ttl=10)
+
+    assert store.load_semantic("scope", 10) == []
+    store.add_semantic("scope", b"vec", "reply", agent.time.time())
+    assert [reply for _, reply, _ in store.load_semantic("scope", 10)] == ["reply"]
+
+
+def test_token_bucket_waits_for_refill_and_caps_burst(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(agent, "time", clock)
+    bucket = agent.TokenBucket(rate=2, capacity=2)
+
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.slept == []
+    bucket.acquire()
+    assert clock.slept == [pytest.approx(0.5)]
+
+    # A long idle spell refills only up to capacity
+    clock.now += 60
+    clock.slept.clear()
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.slept == [pytest.approx(0.5)]
+
+
+def test_batch_eval_maps_results_back_to_messages(monkeypatch, use_state):
+    monkeypatch.setattr(agent, "time", FakeClock())
+    client = FakeBatchOpenAI(statuses=["in_progress", "completed"], failing={"1"})
+    use_state(make_state(openai_client=client))
+
+    replies = agent.run_batch_eval(["one", "two", "three"])
+
+    assert replies == ["re: one", None, "re: three"]
+    assert all("temperature" not in req["body"] for req in client.requests)
+
+
+def test_batch_eval_raises_when_the_job_fails(monkeypatch, use_state):
+    monkeypatch.setattr(agent, "time", FakeClock())
+    use_state(make_state(openai_client=FakeBatchOpenAI(statuses=["expired"])))
+
+    with pytest.raises(RuntimeError, match="expired"):
+        agent.run_batch_eval(["one"])
+
+
+def test_batch_eval_polling_backs_off(monkeypatch, use_state):
+    clock = FakeClock()
+    monkeypatch.setattr(agent, "time", clock)
+    use_state(make_state(openai_client=FakeBatchOpenAI(statuses=["in_progress"] * 7 + ["completed"])))
+
+    agent.run_batch_eval(["one"])
+
+    assert clock.slept == [10, 20, 40, 80, 160, 320, 600, 600]
+
+
+def test_onnx_embedder_mean_pools_over_real_tokens(monkeypatch, tmp_path):
+    np = pytest.importorskip("numpy")
+    monkeypatch.setattr(agent, "np", np, raising=False)
+    loaded = {}
+
+    class FakeModel:
+        config = SimpleNamespace(hidden_size=2)
+
+        @classmethod
+        def from_pretrained(cls, model_dir, file_name):
+            loaded["file_name"] = file_name
+            return cls()
+
+        def __call__(self, input_ids, attention_mask):
+            # The second message is one token long; its padding is huge
+            hidden = np.array([[[1, 0], [3, 0]], [[0, 2], [100, 100]]], dtype="float32")
+            return SimpleNamespace(last_hidden_state=hidden)
+
+    class FakeTokenizer:
+        @classmethod
+        def from_pretrained(cls, model_name):
+            loaded["tokenizer"] = model_name
+            return cls()
+
+        def __call__(self, texts, padding, truncation, return_tensors):
+            return {"input_ids": np.array([[5, 6], [7, 0]]), "attention_mask": np.array([[1, 1], [1, 0]])}
+
+    monkeypatch.setitem(sys.modules, "optimum", SimpleNamespace())
+    monkeypatch.setitem(sys.modules, "optimum.onnxruntime", SimpleNamespace(ORTModelForFeatureExtraction=FakeModel))
+    monkeypatch.setitem(sys.modules, "transformers", SimpleNamespace(AutoTokenizer=FakeTokenizer))
+    with pytest.raises(FileNotFoundError):
+        agent.OnnxEmbedder(str(tmp_path), "all-MiniLM-L6-v2")
+    (tmp_path / "model_quantized.onnx").write_bytes(b"")
+
+    embedder = agent.OnnxEmbedder(str(tmp_path), "all-MiniLM-L6-v2")
+
+    assert loaded == {"file_name": "model_quantized.onnx", "tokenizer": "sentence-transformers/all-MiniLM-L6-v2"}
+    assert embedder.get_sentence_embedding_dimension() == 2
+    np.testing.assert_allclose(embedder.encode(["a b", "c"], normalize_embeddings=False), [[2, 0], [0, 2]])
+    np.testing.assert_allclose(embedder.encode(["a b", "c"]), [[1, 0], [0, 1]])
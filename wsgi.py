@@ -0,0 +1,9 @@
+"""
+WSGI entry point for production servers, e.g.:
+
+    gunicorn -k gevent -w 4 --worker-connections 1000 wsgi:app
+"""
+from agentic_whatsapp_agent import app, get_state
+
+# Each worker imports this after forking, so it sets up its own clients
+get_state()